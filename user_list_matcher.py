@@ -1,31 +1,39 @@
 """
 用户清单匹配补全工具
 依赖：openpyxl（仅此一个第三方库，打包体积极小）
+    版本限定为 3.1.3 ~ 3.1.x：xlsx 快速读取依赖其只读工作表的内部属性，
+    并已在该范围内逐一核对与 iter_rows 的结果一致，升级前需重新核对
 打包命令：
-    pip install pyinstaller openpyxl
+    pip install pyinstaller "openpyxl>=3.1.3,<3.2"
     pyinstaller --onefile --windowed --name 用户清单匹配工具 user_list_matcher.py
 """
 
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
+import codecs
 import csv
 import os
+import xml.etree.ElementTree as ET
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice, repeat
+from operator import itemgetter
 
 # ── 懒加载 openpyxl，仅在实际读写 xlsx 时导入 ──
+# 读写在后台线程中进行，缺少依赖时抛出异常，由界面线程统一提示
 def _openpyxl():
     try:
         import openpyxl
         return openpyxl
     except ImportError:
-        messagebox.showerror("缺少依赖", "请先安装 openpyxl：\npip install openpyxl")
-        return None
+        raise ValueError("缺少依赖，请先安装 openpyxl：\npip install openpyxl") from None
 
 
 # ─────────────────────── 轻量读写工具函数 ───────────────────────
 
 def read_file(path):
-    """读取 xlsx / xls(转csv兼容) / csv，返回 (headers, rows)
-    rows: list of dict {列名: 值}
+    """读取 xlsx / xls(转csv兼容) / csv，返回 (headers, cols)
+    cols: dict {列名: 该列所有值组成的 list}（按列存储，避免每行一个 dict）
     """
     ext = os.path.splitext(path)[1].lower()
     if ext == ".csv":
@@ -36,57 +44,253 @@ def read_file(path):
         raise ValueError(f"不支持的文件格式：{ext}")
 
 
+def row_count(cols):
+    """按列存储的数据行数"""
+    return len(next(iter(cols.values()), []))
+
+
+def _dedup_values(col_lists, sample_size=1000):
+    """重复值较多的列（省、市、供电所等）让相同文本共用同一个 str 对象，降低内存占用"""
+    for col in col_lists:
+        sample = col[:sample_size]
+        if len(set(sample)) * 4 >= len(sample):
+            continue
+        seen = {}
+        col[:] = [seen.setdefault(v, v) for v in col]
+
+
+_CSV_ENCODINGS = ("utf-8-sig", "utf-8", "gbk", "gb2312", "latin-1")
+
+
+def _detect_encoding(path, sample_size=65536):
+    """只读取文件开头的样本判断编码，返回首个能解码样本的候选编码"""
+    with open(path, "rb") as f:
+        sample = f.read(sample_size)
+    # 先做几项快速判断：带 BOM 的直接确定编码；纯 ASCII 在各候选编码下结果相同
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+    if sample.isascii():
+        return "utf-8"
+    final = len(sample) < sample_size  # 样本被截断时末尾可能是半个多字节字符
+    for enc in _CSV_ENCODINGS:
+        try:
+            codecs.getincrementaldecoder(enc)().decode(sample, final=final)
+            return enc
+        except UnicodeDecodeError:
+            continue
+    return _CSV_ENCODINGS[-1]
+
+
 def _read_csv(path):
-    # 自动检测编码
-    for enc in ("utf-8-sig", "utf-8", "gbk", "gb2312", "latin-1"):
+    # 自动检测编码：按样本选定编码后只解析一次；
+    # 若样本之后的内容仍解码失败，再依次尝试后续候选编码
+    enc = _detect_encoding(path)
+    if enc in _CSV_ENCODINGS:
+        candidates = _CSV_ENCODINGS[_CSV_ENCODINGS.index(enc):]
+    else:
+        candidates = (enc,)
+    for enc in candidates:
         try:
             with open(path, newline="", encoding=enc) as f:
-                reader = csv.DictReader(f)
-                headers = reader.fieldnames or []
-                rows = [dict(r) for r in reader]
-            rows = [{k: (v or "") for k, v in r.items()} for r in rows]
-            return list(headers), rows
+                reader = csv.reader(f)
+                headers = next(reader, [])
+                ncols = len(headers)
+                col_lists = [[] for _ in headers]
+                pad = [""] * ncols
+                for row in reader:
+                    if not row:
+                        continue
+                    if len(row) < ncols:
+                        row += pad[len(row):]
+                    for col, val in zip(col_lists, row):
+                        col.append(val)
+            _dedup_values(col_lists)
+            return headers, dict(zip(headers, col_lists))
         except (UnicodeDecodeError, Exception):
             continue
     raise ValueError("无法识别 CSV 文件编码，请另存为 UTF-8 格式后重试。")
 
 
+def _iter_sheet_values(ws):
+    """直接流式解析 read_only 工作表的 sheet XML，逐行产出值元组。
+    结果与 ws.iter_rows(values_only=True) 一致，但不为每个单元格构造中间对象；
+    共享字符串表、日期样式等仍沿用 openpyxl 加载工作簿时已解析好的内容。
+    依赖的 openpyxl 内部属性（已在 3.1.3 ~ 3.1.5 核对）：
+        ws._shared_strings   共享字符串表，按下标取 str
+        ws._get_source()     打开 sheet XML 的文件对象
+        wb._date_formats     日期/时间格式的样式下标集合
+        wb._timedelta_formats  时长格式（[h]:mm 等）的样式下标集合
+    openpyxl 3.1.3 之前时长格式的转换规则不同，结果会与 iter_rows 不一致。
+    """
+    from openpyxl.utils.cell import column_index_from_string
+    from openpyxl.utils.datetime import from_excel, from_ISO8601
+    from openpyxl.xml.constants import SHEET_MAIN_NS
+
+    row_tag, c_tag = f"{{{SHEET_MAIN_NS}}}row", f"{{{SHEET_MAIN_NS}}}c"
+    v_tag, is_tag = f"{{{SHEET_MAIN_NS}}}v", f"{{{SHEET_MAIN_NS}}}is"
+    t_tag, r_tag = f"{{{SHEET_MAIN_NS}}}t", f"{{{SHEET_MAIN_NS}}}r"
+    wb = ws.parent
+    shared = ws._shared_strings
+    date_formats, timedelta_formats = wb._date_formats, wb._timedelta_formats
+    epoch = wb.epoch
+    max_col, max_row = ws.max_column, ws.max_row
+    empty_row = (None,) * max_col if max_col else []  # 与 openpyxl 一致
+    col_index = {}  # 列字母 → 列号，每个文件只换算一次
+
+    with ws._get_source() as src:
+        expected = 1
+        row_idx = 0
+        for _, elem in ET.iterparse(src):
+            if elem.tag != row_tag:
+                continue
+            r = elem.get("r")
+            row_idx = int(r) if r else row_idx + 1
+            if max_row is not None and row_idx > max_row:
+                # dimension 记录的范围小于实际内容时，与 openpyxl 一样补足到 max_row 为止的缺失行
+                while expected <= max_row:
+                    expected += 1
+                    yield empty_row
+                break
+            while expected < row_idx:  # 源文件中缺失的行
+                expected += 1
+                yield empty_row
+            if expected > row_idx:
+                elem.clear()
+                continue
+            expected += 1
+
+            cells = []
+            col = 0
+            for c in elem.iter(c_tag):
+                ref = c.get("r")
+                if ref:
+                    letters = ref.rstrip("0123456789")
+                    col = col_index.get(letters)
+                    if col is None:
+                        col = col_index[letters] = column_index_from_string(letters)
+                else:
+                    col += 1
+                t = c.get("t", "n")
+                if t == "inlineStr":
+                    node = c.find(is_tag)
+                    if node is None:
+                        value = None
+                    else:  # 纯文本 <t> 加富文本各段 <r><t>，不含注音 <rPh>
+                        value = "".join([t.text or "" for t in node.findall(t_tag)]
+                                        + [r.findtext(t_tag) or "" for r in node.findall(r_tag)])
+                else:
+                    value = c.findtext(v_tag) or None
+                    if value is None:
+                        pass
+                    elif t == "n":
+                        value = float(value) if "." in value or "E" in value or "e" in value \
+                            else int(value)
+                        style = c.get("s")
+                        style = int(style) if style else 0
+                        if style in date_formats:
+                            try:
+                                value = from_excel(value, epoch,
+                                                   timedelta=style in timedelta_formats)
+                            except (OverflowError, ValueError):
+                                value = "#VALUE!"
+                    elif t == "s":
+                        value = shared[int(value)]
+                    elif t == "b":
+                        value = bool(int(value))
+                    elif t == "d":
+                        value = from_ISO8601(value)
+                cells.append((col, value))
+            elem.clear()
+
+            width = max_col or (cells[-1][0] if cells else 0)
+            row = [None] * width
+            for col, value in cells:
+                if col <= width:
+                    row[col - 1] = value
+            yield tuple(row)
+
+
 def _read_xlsx(path):
     ox = _openpyxl()
-    if ox is None:
-        return [], []
     wb = ox.load_workbook(path, read_only=True, data_only=True)
     ws = wb.active
-    rows_iter = ws.iter_rows(values_only=True)
-    headers = [str(c) if c is not None else "" for c in next(rows_iter, [])]
-    rows = []
-    for raw in rows_iter:
-        row = {}
-        for i, h in enumerate(headers):
-            val = raw[i] if i < len(raw) else None
-            row[h] = str(val) if val is not None else ""
-        rows.append(row)
+    try:
+        raws = list(_iter_sheet_values(ws))
+    except Exception:
+        # 工作表结构或 openpyxl 内部属性与预期不符时，退回 openpyxl 逐格解析；
+        # 内部属性含义的变化不会抛异常，因此另在打包时限定 openpyxl 版本
+        raws = list(ws.iter_rows(values_only=True))
     wb.close()
-    return headers, rows
-
-
-def write_xlsx(path, headers, rows):
+    headers = [str(c) if c is not None else "" for c in (raws[0] if raws else [])]
+    # 不足表头宽度的行先整行补齐，再按列取值并统一转换为字符串；
+    # xlsx 中大部分单元格本身就是 str，无需再调用 str()
+    ncols = len(headers)
+    pad = (None,) * ncols
+    raws = [r if len(r) >= ncols else tuple(r) + pad[len(r):] for r in islice(raws, 1, None)]
+    col_lists = [
+        ["" if v is None else v if type(v) is str else str(v) for v in map(itemgetter(j), raws)]
+        for j in range(ncols)
+    ]
+    del raws
+    _dedup_values(col_lists)
+    return headers, dict(zip(headers, col_lists))
+
+
+def write_xlsx(path, headers, cols):
     ox = _openpyxl()
-    if ox is None:
-        return
-    wb = ox.Workbook()
-    ws = wb.active
+    # write_only 模式逐行写入磁盘，不在内存中保留 Cell 对象
+    wb = ox.Workbook(write_only=True)
+    ws = wb.create_sheet()
     ws.append(headers)
-    for row in rows:
-        ws.append([row.get(h, "") for h in headers])
+    col_lists = [cols.get(h) or [""] * row_count(cols) for h in headers]
+    for row in zip(*col_lists):
+        ws.append(row)
     wb.save(path)
 
 
-def write_csv(path, headers, rows):
+def write_csv(path, headers, cols):
+    col_lists = [cols.get(h) or [""] * row_count(cols) for h in headers]
     with open(path, "w", newline="", encoding="utf-8-sig") as f:
-        writer = csv.DictWriter(f, fieldnames=headers, extrasaction="ignore")
-        writer.writeheader()
-        writer.writerows(rows)
+        writer = csv.writer(f)
+        writer.writerow(headers)
+        # zip 逐行惰性生成，任一时刻只有一行数据处于物化状态
+        writer.writerows(zip(*col_lists))
+
+
+# ─────────────────────────── 匹配 ───────────────────────────
+
+def match_rows(full_key_col, masked_key_col):
+    """按匹配键关联两份清单，返回脱敏清单每一行对应的全量清单行号（-1 表示未匹配）
+    键值比较前去除首尾空白；全量清单键重复时取最后一行，空键不参与匹配。
+    """
+    lookup = dict(zip(map(str.strip, full_key_col), range(len(full_key_col))))
+    lookup.pop("", None)
+    # 行号直接写入 array，不先生成整列 int 对象的临时 list；
+    # 去空白与查表都以绑定好的方法交给 map，逐行不再有属性查找和 Python 字节码
+    return array("i", map(lookup.get, map(str.strip, masked_key_col), repeat(-1)))
+
+
+def fill_columns(full_cols, masked_cols, full_key, masked_key, col_plan):
+    """按 col_plan [(src_col, write_col)] 从全量清单补全脱敏清单，返回 (result_cols, matched_count)"""
+    n = row_count(masked_cols)
+    # 先为每一行查出全量清单中的行号（-1 表示未匹配），
+    # 再按映射逐列整体取值；原有列直接复用，不复制
+    indices = match_rows(full_cols.get(full_key, []),
+                         masked_cols.get(masked_key) or [""] * n)
+    matched_count = n - indices.count(-1)
+    result_cols = dict(masked_cols)
+    blank = [""] * n  # 源列不存在时各映射共用的空列，只读
+    for src_col, write_col in col_plan:
+        src = full_cols.get(src_col)
+        if src is None:
+            result_cols[write_col] = blank
+        else:
+            # 末尾补一个空值，使行号 -1 正好取到 ""，整列取值在 C 层完成
+            padded = src + [""]
+            result_cols[write_col] = list(map(padded.__getitem__, indices))
+    return result_cols, matched_count
 
 
 # ─────────────────────────── 主窗口 ───────────────────────────
@@ -100,11 +304,17 @@ class UserListMatcher:
         self.root.resizable(True, True)
 
         self.full_headers = []
-        self.full_rows = []
+        self.full_cols = {}
         self.masked_headers = []
-        self.masked_rows = []
+        self.masked_cols = {}
         self.mapping_rows = []
 
+        # 读取、匹配、导出放到后台线程执行，避免大文件处理时界面卡死；
+        # 两个工作线程使两份清单可以同时读取
+        self._executor = ThreadPoolExecutor(max_workers=2)
+        self._load_futures = {}  # 槽位 "full"/"masked" → 该槽位当前正在读取的 future
+        self._running = False
+
         self._build_ui()
 
     # ──────────────────────── UI 构建 ────────────────────────────
@@ -199,11 +409,12 @@ class UserListMatcher:
 
         run_frame = tk.Frame(bottom, bg="#f0f4f8")
         run_frame.pack(side=tk.RIGHT)
-        tk.Button(run_frame, text="▶  开始匹配并导出",
-                  font=("Microsoft YaHei", 11, "bold"),
-                  bg="#2980b9", fg="white", activebackground="#1a6fa8",
-                  relief="flat", padx=18, pady=10,
-                  cursor="hand2", command=self._run).pack()
+        self.run_btn = tk.Button(run_frame, text="▶  开始匹配并导出",
+                                 font=("Microsoft YaHei", 11, "bold"),
+                                 bg="#2980b9", fg="white", activebackground="#1a6fa8",
+                                 relief="flat", padx=18, pady=10,
+                                 cursor="hand2", command=self._run)
+        self.run_btn.pack()
 
         self.status_var = tk.StringVar(value="请先导入两份清单文件。")
         tk.Label(self.root, textvariable=self.status_var,
@@ -220,7 +431,9 @@ class UserListMatcher:
         tk.Label(row, textvariable=path_var, bg="#ffffff", anchor="w",
                  relief="groove", font=("Microsoft YaHei", 9),
                  fg="#555", padx=6, pady=3, width=55).pack(side=tk.LEFT, padx=(0, 8))
-        ttk.Button(row, text="浏览…", command=cmd).pack(side=tk.LEFT)
+        browse_btn = ttk.Button(row, text="浏览…", command=cmd)
+        browse_btn.pack(side=tk.LEFT)
+        setattr(self, f"{tag}_browse_btn", browse_btn)
         info_var = tk.StringVar(value="")
         setattr(self, f"{tag}_info_var", info_var)
         ttk.Label(row, textvariable=info_var, foreground="#27ae60").pack(side=tk.LEFT, padx=8)
@@ -237,14 +450,27 @@ class UserListMatcher:
         path = self._load_file_dialog("选择全量用户清单")
         if not path:
             return
+        self.full_browse_btn.config(state=tk.DISABLED)
+        self._load_futures["full"] = self._submit(
+            f"正在读取全量清单：{os.path.basename(path)} …",
+            lambda fut: self._on_full_loaded(path, fut), read_file, path)
+        self._update_run_btn()
+
+    def _on_full_loaded(self, path, future):
+        if self._load_futures.get("full") is not future:
+            return  # 已被之后选择的文件取代
+        del self._load_futures["full"]
+        self.full_browse_btn.config(state=tk.NORMAL)
+        self._update_run_btn()
         try:
-            headers, rows = read_file(path)
+            headers, cols = future.result()
         except Exception as e:
+            self.status_var.set(f"读取失败：{os.path.basename(path)}")
             messagebox.showerror("读取失败", str(e))
             return
-        self.full_headers, self.full_rows = headers, rows
+        self.full_headers, self.full_cols = headers, cols
         self.full_path_var.set(path)
-        self.full_info_var.set(f"✓ {len(rows)} 行 × {len(headers)} 列")
+        self.full_info_var.set(f"✓ {row_count(cols)} 行 × {len(headers)} 列")
         self.full_key_cb["values"] = headers
         if headers:
             self.full_key_cb.current(0)
@@ -255,20 +481,55 @@ class UserListMatcher:
         path = self._load_file_dialog("选择脱敏用户清单")
         if not path:
             return
+        self.masked_browse_btn.config(state=tk.DISABLED)
+        self._load_futures["masked"] = self._submit(
+            f"正在读取脱敏清单：{os.path.basename(path)} …",
+            lambda fut: self._on_masked_loaded(path, fut), read_file, path)
+        self._update_run_btn()
+
+    def _on_masked_loaded(self, path, future):
+        if self._load_futures.get("masked") is not future:
+            return  # 已被之后选择的文件取代
+        del self._load_futures["masked"]
+        self.masked_browse_btn.config(state=tk.NORMAL)
+        self._update_run_btn()
         try:
-            headers, rows = read_file(path)
+            headers, cols = future.result()
         except Exception as e:
+            self.status_var.set(f"读取失败：{os.path.basename(path)}")
             messagebox.showerror("读取失败", str(e))
             return
-        self.masked_headers, self.masked_rows = headers, rows
+        self.masked_headers, self.masked_cols = headers, cols
         self.masked_path_var.set(path)
-        self.masked_info_var.set(f"✓ {len(rows)} 行 × {len(headers)} 列")
+        self.masked_info_var.set(f"✓ {row_count(cols)} 行 × {len(headers)} 列")
         self.masked_key_cb["values"] = headers
         if headers:
             self.masked_key_cb.current(0)
         self._refresh_mapping_combos()
         self.status_var.set(f"已加载脱敏清单：{os.path.basename(path)}")
 
+    # ──────────────────────── 后台任务 ────────────────────────────
+
+    def _submit(self, status, callback, func, *args):
+        """在后台线程执行 func(*args)，完成后在界面线程调用 callback(future)
+        后台线程中不得操作任何 Tk 控件，结果与异常都通过 future 交回界面线程处理。
+        """
+        self.status_var.set(status)
+        future = self._executor.submit(func, *args)
+        self.root.after(100, self._poll, future, callback)
+        return future
+
+    def _poll(self, future, callback):
+        if future.done():
+            callback(future)
+        else:
+            self.root.after(100, self._poll, future, callback)
+
+    def _update_run_btn(self):
+        """清单读取中或匹配导出进行中时禁用执行按钮"""
+        busy = bool(self._load_futures) or self._running
+        self.run_btn.config(state=tk.DISABLED if busy else tk.NORMAL)
+
     # ──────────────────────── 列映射行 ────────────────────────────
 
     def _add_mapping_row(self):
@@ -325,7 +586,10 @@ class UserListMatcher:
     # ──────────────────────── 执行匹配 ────────────────────────────
 
     def _run(self):
-        if not self.full_rows or not self.masked_rows:
+        if self._load_futures or self._running:
+            messagebox.showwarning("提示", "清单仍在读取或导出中，请稍候再试！")
+            return
+        if not row_count(self.full_cols) or not row_count(self.masked_cols):
             messagebox.showwarning("提示", "请先导入全量清单和脱敏清单！")
             return
 
@@ -340,13 +604,6 @@ class UserListMatcher:
             messagebox.showwarning("提示", "请至少添加一条列映射关系！")
             return
 
-        # 构建查找表
-        lookup = {}
-        for row in self.full_rows:
-            k = str(row.get(full_key, "")).strip()
-            if k:
-                lookup[k] = row
-
         # 确定输出列顺序，处理新增列命名冲突
         result_headers = list(self.masked_headers)
         col_plan = []  # [(src_col, write_col)]
@@ -368,22 +625,6 @@ class UserListMatcher:
                 write_col = dst_col
             col_plan.append((src_col, write_col))
 
-        # 生成结果行
-        result_rows = []
-        matched_count = 0
-        for row in self.masked_rows:
-            new_row = dict(row)
-            key_val = str(row.get(masked_key, "")).strip()
-            src = lookup.get(key_val)
-            if src:
-                matched_count += 1
-            for src_col, write_col in col_plan:
-                new_row[write_col] = src.get(src_col, "") if src else ""
-            result_rows.append(new_row)
-
-        total = len(result_rows)
-        unmatched = total - matched_count
-
         out_fmt = self.out_fmt_var.get()
         ext = ".xlsx" if out_fmt == "xlsx" else ".csv"
         out_path = filedialog.asksaveasfilename(
@@ -394,22 +635,47 @@ class UserListMatcher:
         if not out_path:
             return
 
+        full_cols, masked_cols = self.full_cols, self.masked_cols
+        self._running = True
+        self._update_run_btn()
+        self._submit("正在匹配 …",
+                     lambda fut: self._on_match_done(out_fmt, out_path, result_headers, fut),
+                     fill_columns, full_cols, masked_cols, full_key, masked_key, col_plan)
+
+    def _on_match_done(self, out_fmt, out_path, result_headers, future):
         try:
-            if out_fmt == "xlsx":
-                write_xlsx(out_path, result_headers, result_rows)
-            else:
-                write_csv(out_path, result_headers, result_rows)
-
-            msg = (f"✅ 匹配完成！\n\n"
-                   f"总行数：{total}\n"
-                   f"成功匹配：{matched_count} 行\n"
-                   f"未匹配（键值不存在）：{unmatched} 行\n\n"
-                   f"已保存至：\n{out_path}")
-            messagebox.showinfo("完成", msg)
-            self.status_var.set(
-                f"已导出：{os.path.basename(out_path)}  | 匹配 {matched_count}/{total} 行")
+            result_cols, matched_count = future.result()
         except Exception as e:
+            self._running = False
+            self._update_run_btn()
+            self.status_var.set("匹配失败。")
+            messagebox.showerror("匹配失败", f"匹配时出错：\n{e}")
+            return
+        writer = write_xlsx if out_fmt == "xlsx" else write_csv
+        total = row_count(result_cols)
+        self._submit("正在导出 …",
+                     lambda fut: self._on_run_done(out_path, total, matched_count, fut),
+                     writer, out_path, result_headers, result_cols)
+
+    def _on_run_done(self, out_path, total, matched_count, future):
+        self._running = False
+        self._update_run_btn()
+        try:
+            future.result()
+        except Exception as e:
+            self.status_var.set("导出失败。")
             messagebox.showerror("保存失败", f"保存文件时出错：\n{e}")
+            return
+        unmatched = total - matched_count
+
+        msg = (f"✅ 匹配完成！\n\n"
+               f"总行数：{total}\n"
+               f"成功匹配：{matched_count} 行\n"
+               f"未匹配（键值不存在）：{unmatched} 行\n\n"
+               f"已保存至：\n{out_path}")
+        messagebox.showinfo("完成", msg)
+        self.status_var.set(
+            f"已导出：{os.path.basename(out_path)}  | 匹配 {matched_count}/{total} 行")
 
 
 # ─────────────────────────── 入口 ───────────────────────────